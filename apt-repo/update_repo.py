@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-import os, re, time, subprocess, hashlib, requests, sys, urllib.parse
+import os, re, time, subprocess, hashlib, requests, sys, urllib.parse, gzip, multiprocessing
 from pathlib import Path
 from functools import cmp_to_key
+from concurrent.futures import ProcessPoolExecutor
 
 # =========================
 #  Configuración general
@@ -13,9 +14,26 @@ COMP = "main"
 GPG_KEY_ID = "Pablo M. Duval <pabloduval@proton.me>"
 CHECK_INTERVAL_SECS = 900  # 15 minutos
 
-# Arquitecturas: amd64 real; i386/arm64/armhf índices vacíos (para evitar avisos)
+# Arquitecturas: cada .deb va al índice de su campo Architecture; "all" entra en todos.
+# PRIMARY_ARCH sólo se usa para nombrar descargas de upstream (todas amd64).
 PRIMARY_ARCH = "amd64"
 ARCHES = ["amd64", "i386", "arm64", "armhf"]
+INDEX_WORKERS = min(len(ARCHES), os.cpu_count() or 1)  # procesos para generar índices
+
+# Índices por perfil de CPU: suite aparte con "main" (apps) + "kernel-<cpu>",
+# para que cada cliente descargue sólo la metadata de su kernel.
+# La suite combinada (DIST/COMP) se mantiene por compatibilidad.
+# Al desactivar una suite, ensure_layout() borra su dists/<suite> para no servir
+# índices/Release viejos (los clientes que aún la usen verán 404).
+PUBLISH_COMBINED = True
+SPLIT_BY_PROFILE = True
+SPLIT_DIST = "split"
+SPLIT_APPS_COMP = "main"
+KERNEL_COMP_PREFIX = "kernel-"
+
+# Caché de apt-ftparchive (checksums/control por .deb); fuera de dists/ y pool/
+CACHE_DIR = REPO_DIR / ".cache"
+PACKAGES_DB = CACHE_DIR / "packages.db"
 
 # Endpoint común para GitHub (usado por varios módulos)
 GITHUB_API = "https://api.github.com"
@@ -61,6 +79,8 @@ CPU_PROFILES = [
 # regex para nombres de assets (image/headers) - excluye dbg/libc
 KIMG_RE = re.compile(r"^linux-image-(?P<ver>[^_]+)-tkg-redroot-(?P<cpu>[^_]+)_.*amd64\.deb$")
 KHDR_RE = re.compile(r"^linux-headers-(?P<ver>[^_]+)-tkg-redroot-(?P<cpu>[^_]+)_.*amd64\.deb$")
+# nombre de paquete (real o meta) -> perfil de CPU
+KPKG_RE = re.compile(r"^linux-(?:image|headers)-(?:.+-)?redroot-(?P<cpu>.+)$")
 
 # =========================
 #  Utilidades / log
@@ -91,9 +111,40 @@ def sort_versions_debian(versions):
 # =========================
 #  Infra repo
 # =========================
+def published_suites():
+    """Devuelve {suite: [componentes]} según PUBLISH_COMBINED / SPLIT_BY_PROFILE."""
+    suites = {}
+    if PUBLISH_COMBINED:
+        suites[DIST] = [COMP]
+    if SPLIT_BY_PROFILE:
+        suites[SPLIT_DIST] = [SPLIT_APPS_COMP] + [f"{KERNEL_COMP_PREFIX}{cpu}" for cpu in CPU_PROFILES]
+    return suites
+
 def ensure_layout():
-    for arch in ARCHES:
-        (REPO_DIR / "dists" / DIST / COMP / f"binary-{arch}").mkdir(parents=True, exist_ok=True)
+    suites = published_suites()
+    for dist, comps in suites.items():
+        for comp in comps:
+            for arch in ARCHES:
+                (REPO_DIR / "dists" / dist / comp / f"binary-{arch}").mkdir(parents=True, exist_ok=True)
+    for dist in (DIST, SPLIT_DIST):
+        stale = REPO_DIR / "dists" / dist
+        if dist not in suites and stale.exists():
+            log(f"Suite {dist} desactivada; borrando dists/{dist}")
+            subprocess.run(["rm","-rf",str(stale)], check=True)
+    # Componentes (p. ej. un perfil quitado de CPU_PROFILES) o arquitecturas retirados
+    for dist, comps in suites.items():
+        for d in (REPO_DIR / "dists" / dist).iterdir():
+            if not d.is_dir():
+                continue
+            if d.name not in comps:
+                log(f"Componente {dist}/{d.name} ya no publicado; borrando")
+                subprocess.run(["rm","-rf",str(d)], check=True)
+                continue
+            for b in d.glob("binary-*"):
+                if b.name.removeprefix("binary-") not in ARCHES:
+                    log(f"Arquitectura {dist}/{d.name}/{b.name} ya no publicada; borrando")
+                    subprocess.run(["rm","-rf",str(b)], check=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
     (REPO_DIR / "pool" / "main" / "discord").mkdir(parents=True, exist_ok=True)
     (REPO_DIR / "pool" / "main" / FREETUBE_SUBDIR).mkdir(parents=True, exist_ok=True)
     (REPO_DIR / "pool" / "main" / GH_DESKTOP_SUBDIR).mkdir(parents=True, exist_ok=True)
@@ -364,6 +415,13 @@ def ingest_redroot_kernels():
 #  Metapaquetes (alias estables)
 # =========================
 def build_meta_pkg(pkgname: str, depends: str, version: str, out_dir: Path):
+    deb_path = out_dir / f"{pkgname}_{version}_amd64.deb"
+    sha_path = deb_path.with_suffix(".deb.sha256")
+    if deb_path.exists():
+        # mismo nombre/versión = mismo contenido; no invalidar la caché del índice
+        if not sha_path.exists():
+            sha_path.write_text(f"{sha256sum(deb_path)}  {deb_path.name}\n", encoding="utf-8")
+        return deb_path
     work = out_dir / f".meta-{pkgname}"
     if work.exists():
         subprocess.run(["rm","-rf",str(work)], check=True)
@@ -378,9 +436,8 @@ Maintainer: {GPG_KEY_ID}
 Description: Meta package for {pkgname}; pulls latest {depends}
 """
     (work / "DEBIAN" / "control").write_text(control, encoding="utf-8")
-    deb_path = out_dir / f"{pkgname}_{version}_amd64.deb"
     sh(["dpkg-deb","--build",str(work),str(deb_path)])
-    (deb_path.with_suffix(".deb.sha256")).write_text(
+    sha_path.write_text(
         f"{sha256sum(deb_path)}  {deb_path.name}\n", encoding="utf-8"
     )
     log(f"Metapaquete generado: {deb_path.name}")
@@ -414,58 +471,189 @@ def synthesize_kernel_meta_packages():
 # =========================
 #  Índices APT y firma
 # =========================
-def generate_packages():
-    pool_main = REPO_DIR / "pool" / "main"
-    bin_dir = REPO_DIR / "dists" / DIST / COMP / f"binary-{PRIMARY_ARCH}"
-
-    cmd = (
-        f"dpkg-scanpackages -m {pool_main.relative_to(REPO_DIR)} /dev/null | "
-        f"tee {bin_dir/'Packages'} | gzip -9 > {bin_dir/'Packages.gz'}"
+def scan_pool():
+    """
+    Escanea pool/main con apt-ftparchive usando una DB de caché: sólo los .deb
+    nuevos o modificados se vuelven a leer/hashear. Devuelve [(campos, stanza)]
+    ordenado por Filename para que los índices sean estables entre ciclos.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    out = subprocess.run(
+        ["apt-ftparchive", "--db", str(PACKAGES_DB), "packages", "pool/main"],
+        cwd=REPO_DIR, capture_output=True, text=True
     )
-    out = subprocess.run(["bash","-lc", cmd], cwd=REPO_DIR, capture_output=True, text=True)
     if out.returncode != 0:
-        err(out.stderr); raise RuntimeError("dpkg-scanpackages falló")
-    entries = len([ln for ln in out.stdout.splitlines() if ln.strip()])
-    log(f"Entradas {PRIMARY_ARCH} en Packages: {entries}")
+        err(out.stderr); raise RuntimeError("apt-ftparchive packages falló")
 
-    for arch in ARCHES:
-        if arch == PRIMARY_ARCH:
+    stanzas = []
+    for block in re.split(r"\n\s*\n", out.stdout):
+        block = block.strip("\n")
+        if not block.strip():
             continue
-        bdir = REPO_DIR / "dists" / DIST / COMP / f"binary-{arch}"
-        (bdir / "Packages").write_text("", encoding="utf-8")
-        subprocess.run(
-            ["bash","-lc", f"gzip -9c < {bdir/'Packages'} > {bdir/'Packages.gz'}"],
-            cwd=REPO_DIR, check=True, capture_output=True, text=True
-        )
-        log(f"Generado índice vacío para {arch}")
+        fields = {}
+        for ln in block.splitlines():
+            if ln[:1] in (" ", "\t") or ":" not in ln:
+                continue
+            k, v = ln.split(":", 1)
+            fields[k] = v.strip()
+        stanzas.append((fields, block + "\n"))
+    stanzas.sort(key=lambda st: st[0].get("Filename", ""))
+    return stanzas
+
+def split_component_for(pkg: str) -> str:
+    """Componente de la suite dividida: kernel-<cpu> para kernels/metas, si no SPLIT_APPS_COMP."""
+    m = KPKG_RE.match(pkg)
+    if m and m.group("cpu") in CPU_PROFILES:
+        return f"{KERNEL_COMP_PREFIX}{m.group('cpu')}"
+    return SPLIT_APPS_COMP
+
+def write_index(bin_dir: Path, content: str) -> bool:
+    """Escribe Packages(.gz) sólo si el contenido cambió. Devuelve True si se reescribió."""
+    pkgs = bin_dir / "Packages"
+    if pkgs.exists() and (bin_dir / "Packages.gz").exists() \
+            and pkgs.read_text(encoding="utf-8") == content:
+        return False
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    pkgs.write_text(content, encoding="utf-8")
+    with gzip.GzipFile(bin_dir / "Packages.gz", "wb", compresslevel=9, mtime=0) as f:
+        f.write(content.encode("utf-8"))
+    return True
+
+def build_arch_indexes(repo_dir: str, arch: str, suites: dict[str, list[str]],
+                       stanzas: list[tuple[str, str]]):
+    """
+    Worker (proceso aparte): reparte las stanzas de una arquitectura (incluidas
+    las "all") entre los componentes publicados y escribe sus Packages(.gz).
+    stanzas = [(Package, stanza)]. Devuelve las suites con algún índice reescrito.
+    """
+    entries = {(dist, comp): [] for dist, comps in suites.items() for comp in comps}
+    for pkg, raw in stanzas:
+        if DIST in suites:
+            entries[(DIST, COMP)].append(raw)
+        if SPLIT_DIST in suites:
+            entries[(SPLIT_DIST, split_component_for(pkg))].append(raw)
+
+    changed = set()
+    for (dist, comp), raws in entries.items():
+        if write_index(Path(repo_dir) / "dists" / dist / comp / f"binary-{arch}", "\n".join(raws)):
+            changed.add(dist)
+            log(f"Índice {dist}/{comp}/binary-{arch}: {len(raws)} entradas")
+    return changed
 
-def generate_release():
-    dists = REPO_DIR / "dists" / DIST
+def generate_packages():
+    """
+    Genera los índices de todas las suites publicadas. Cada arquitectura se
+    construye en un worker y sólo si su conjunto de paquetes cambió.
+    Devuelve {arch: digest} de las arquitecturas regeneradas; publish_indexes()
+    los guarda en CACHE_DIR una vez firmados los Release.
+    """
+    stanzas = scan_pool()
+    suites = published_suites()
+
+    # Reparto por campo Architecture del control; "all" entra en todas
+    by_arch = {arch: [] for arch in ARCHES}
+    hashes = {arch: hashlib.sha256(repr(sorted(suites.items())).encode("utf-8")) for arch in ARCHES}
+    for fields, raw in stanzas:
+        arch = fields.get("Architecture", "")
+        if arch == "all":
+            targets = ARCHES
+        elif arch in ARCHES:
+            targets = [arch]
+        else:
+            warn(f"{fields.get('Filename', '?')}: arquitectura '{arch}' no publicada; skip.")
+            continue
+        key = f"{fields.get('Filename', '')}\0{fields.get('SHA256', '')}\n".encode("utf-8")
+        for t in targets:
+            by_arch[t].append((fields.get("Package", ""), raw))
+            hashes[t].update(key)
+
+    # Sólo reconstruir arquitecturas cuyo conjunto de paquetes cambió
+    pending = {}  # arch -> digest
+    for arch in ARCHES:
+        digest = hashes[arch].hexdigest()
+        sig = CACHE_DIR / f"index-{arch}.sha256"
+        missing = any(not (REPO_DIR / "dists" / dist / comp / f"binary-{arch}" / "Packages.gz").exists()
+                      for dist, comps in suites.items() for comp in comps)
+        if missing or not sig.exists() or sig.read_text(encoding="utf-8").strip() != digest:
+            pending[arch] = digest
+
+    changed = set()
+    if pending:
+        # Pool por publicación: nada queda vivo entre ciclos ni arrastra un worker muerto.
+        # spawn porque el daemon corre en un hilo junto al servidor HTTP (run.py).
+        with ProcessPoolExecutor(max_workers=min(INDEX_WORKERS, len(pending)),
+                                 mp_context=multiprocessing.get_context("spawn")) as ex:
+            futs = [ex.submit(build_arch_indexes, str(REPO_DIR), arch, suites, by_arch[arch]) for arch in pending]
+            for fut in futs:
+                changed |= fut.result()
+
+    counts = ", ".join(f"{a}={len(v)}" for a, v in by_arch.items())
+    log(f"Entradas en pool: {len(stanzas)} ({counts}); "
+        f"arquitecturas regeneradas: {', '.join(pending) or 'ninguna'}; "
+        f"suites con cambios: {', '.join(sorted(changed)) or 'ninguna'}")
+    return pending
+
+def generate_release(dist: str, components: list[str]):
+    dists = REPO_DIR / "dists" / dist
     conf = REPO_DIR / "apt-ftparchive.conf"
+    # Config común; Suite/Codename/Components van por -o para cada suite
     conf.write_text(
     f"""Dir::ArchiveDir "{REPO_DIR}";
 Dir::CacheDir "{REPO_DIR}";
-APT::FTPArchive::Release::Suite "{DIST}";
-APT::FTPArchive::Release::Codename "{DIST}";
-APT::FTPArchive::Release::Components "{COMP}";
 APT::FTPArchive::Release::Architectures "{' '.join(ARCHES)}";
 """, encoding="utf-8")
     rel_path = dists / "Release"
-    log("Generando Release…")
+    log(f"Generando Release de {dist}…")
     out = subprocess.run(
-        ["apt-ftparchive", "-c", str(conf), "release", f"dists/{DIST}"],
+        ["apt-ftparchive", "-c", str(conf),
+         "-o", f"APT::FTPArchive::Release::Suite={dist}",
+         "-o", f"APT::FTPArchive::Release::Codename={dist}",
+         "-o", f"APT::FTPArchive::Release::Components={' '.join(components)}",
+         "release", f"dists/{dist}"],
         cwd=REPO_DIR, capture_output=True, text=True
     )
     if out.returncode != 0:
         err(out.stderr); raise RuntimeError("apt-ftparchive falló")
     rel_path.write_text(out.stdout, encoding="utf-8")
 
-    log("Firmando InRelease y Release.gpg…")
+    log(f"Firmando InRelease y Release.gpg de {dist}…")
     sh(["gpg","--batch","--yes","--pinentry-mode","loopback","-u",GPG_KEY_ID,
         "--output",str(dists/"InRelease"), "--clearsign", str(rel_path)])
     sh(["gpg","--batch","--yes","--pinentry-mode","loopback","-u",GPG_KEY_ID,
         "--output",str(dists/"Release.gpg"), "--detach-sign", str(rel_path)])
 
+def release_is_stale(dist: str, components: list[str]) -> bool:
+    """
+    True si falta Release/InRelease/Release.gpg, si su Components/Architectures
+    no coincide con lo publicado, o si algún Packages* de la suite es más nuevo
+    que ellos (p. ej. un ciclo anterior reescribió índices y luego falló
+    apt-ftparchive o gpg). Se basa en disco, así sobrevive a reinicios.
+    """
+    ddir = REPO_DIR / "dists" / dist
+    signed = [ddir / "Release", ddir / "InRelease", ddir / "Release.gpg"]
+    if not all(p.exists() for p in signed):
+        return True
+    header = {}
+    for ln in (ddir / "Release").read_text(encoding="utf-8").splitlines():
+        if ln[:1] in (" ", "\t") or ":" not in ln:
+            continue
+        k, v = ln.split(":", 1)
+        header[k] = v.split()
+    if header.get("Components") != components or header.get("Architectures") != ARCHES:
+        return True
+    oldest = min(p.stat().st_mtime_ns for p in signed)
+    return any(p.stat().st_mtime_ns > oldest for p in ddir.glob("*/binary-*/Packages*"))
+
+def publish_indexes(force_release: bool = False):
+    """Índices + Release firmado, sólo para suites con índices más nuevos que su firma."""
+    digests = generate_packages()
+    for dist, comps in published_suites().items():
+        if force_release or release_is_stale(dist, comps):
+            generate_release(dist, comps)
+    # Sólo con todo firmado: si algo falló, esas arquitecturas se reintentan
+    for arch, digest in digests.items():
+        (CACHE_DIR / f"index-{arch}.sha256").write_text(digest + "\n", encoding="utf-8")
+
 def export_pubkey():
     keyfile = REPO_DIR / "KEY.asc"
     subprocess.run(
@@ -479,8 +667,7 @@ def export_pubkey():
 # =========================
 def initial_build():
     ensure_layout()
-    generate_packages()
-    generate_release()
+    publish_indexes(force_release=True)
     export_pubkey()
 
 def one_cycle():
@@ -518,9 +705,12 @@ def one_cycle():
 
     if changed:
         synthesize_kernel_meta_packages()
-        generate_packages()
-        generate_release()
+        publish_indexes()
         export_pubkey()
+    elif any(release_is_stale(d, c) for d, c in published_suites().items()):
+        # un ciclo anterior dejó índices sin firmar (falló apt-ftparchive/gpg)
+        warn("Sin cambios nuevos, pero hay Release desactualizado; regenerando.")
+        publish_indexes()
     else:
         log("Sin cambios; ya estaban las versiones actuales.")
 